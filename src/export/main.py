@@ -17,6 +17,12 @@ DYNAMODB_TABLE = os.getenv('DYNAMODB_TABLE')
 SSM_URL = 'http://localhost:2773/systemsmanager/parameters/get?withDecryption=true&name='
 BASE_URL = 'https://intervals.icu/api/v1/athlete/'
 FULL_IMPORT = False
+EXPORT_DAYS = 7
+
+# Wellness fields to keep a running baseline of, and the size of the rolling window in days
+HEALTH_STATS_FIELDS = ['weight', 'restingHR', 'hrv', 'steps']
+HEALTH_STATS_SK = 'STATS#HEALTH'
+HEALTH_WINDOW_DAYS = 28
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(DYNAMODB_TABLE)
@@ -43,7 +49,7 @@ def fetch_data(url, auth_key, retries=3, delay=2):
 
 def determine_export_from():
     """Determine the start date for data export."""
-    return '2010-01-01' if FULL_IMPORT else (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+    return '2010-01-01' if FULL_IMPORT else (datetime.now() - timedelta(days=EXPORT_DAYS)).strftime('%Y-%m-%d')
 
 def classify_activity(activity_type):
     """Map activity types to standardized values."""
@@ -123,9 +129,59 @@ def process_personal_records(activity, item, intervals_uid):
                 raise
 
 
+def get_health_stats(intervals_uid):
+    """Fetch the running wellness statistics for a user, or start a new set if none exist."""
+    key = {'PK': f'USER#{intervals_uid}', 'SK': HEALTH_STATS_SK}
+    stats = table.get_item(Key=key).get('Item') or {**key, 'last_date': None, 'folded_to': None}
+    for field in HEALTH_STATS_FIELDS:
+        stats.setdefault(field, {'count': 0, 'mean': Decimal(0), 'm2': Decimal(0), 'window': {}})
+    return stats
+
+def update_health_stats(stats, item):
+    """Write a health item's values into the rolling window of each field.
+    Values are rewritten on every run so later updates from intervals.icu are picked up."""
+    date = item['GSI1SK']
+    if date >= datetime.now().strftime('%Y-%m-%d'):
+        return False
+
+    for field in HEALTH_STATS_FIELDS:
+        if field in item:
+            stats[field]['window'][date] = Decimal(item[field])
+        else:
+            stats[field]['window'].pop(date, None)
+
+    stats['last_date'] = max(stats['last_date'] or date, date)
+    return True
+
+def fold_health_stats(stats):
+    """Fold days that have left the re-import period into the all time Welford mean/variance, then trim the windows.
+    Days are only folded once they can no longer be changed by a later export run."""
+    fold_before = (datetime.now() - timedelta(days=EXPORT_DAYS)).strftime('%Y-%m-%d')
+    window_from = (datetime.now() - timedelta(days=HEALTH_WINDOW_DAYS)).strftime('%Y-%m-%d')
+
+    dates = sorted({d for field in HEALTH_STATS_FIELDS for d in stats[field]['window']})
+    for date in dates:
+        if date >= fold_before or (stats['folded_to'] and date <= stats['folded_to']):
+            continue
+        for field in HEALTH_STATS_FIELDS:
+            field_stats = stats[field]
+            if date in field_stats['window']:
+                value = field_stats['window'][date]
+                field_stats['count'] += 1
+                delta = value - field_stats['mean']
+                field_stats['mean'] += delta / field_stats['count']
+                field_stats['m2'] += delta * (value - field_stats['mean'])
+        stats['folded_to'] = date
+
+    for field in HEALTH_STATS_FIELDS:
+        stats[field]['window'] = {d: v for d, v in stats[field]['window'].items() if d >= window_from}
+
 def process_health_data(health_entries, intervals_uid):
     """Process and store health data in DynamoDB."""
-    for entry in health_entries:
+    stats = get_health_stats(intervals_uid)
+    stats_updated = False
+
+    for entry in sorted(health_entries, key=lambda e: e['id']):
         item = {
             'PK': f'USER#{intervals_uid}',
             'SK': f'HEALTH#{entry['id'].replace('-', '#')}',
@@ -141,12 +197,17 @@ def process_health_data(health_entries, intervals_uid):
         if all(k in item for k in ('atl', 'ctl', 'rampRate')) and all(item[k] != 0 for k in ('atl', 'ctl', 'rampRate')):
             try:
                 table.put_item(Item=item)
+                stats_updated |= update_health_stats(stats, item)
             except ClientError as e:
                 if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
                     raise
         else:
             print("Skipping entry with insufficient data.")
 
+    if stats_updated:
+        fold_health_stats(stats)
+        table.put_item(Item=stats)
+
 
 def main(event, context):
     """Main function to orchestrate data retrieval and processing."""
@@ -6,6 +6,7 @@ import calendar
 import boto3
 import pandas as pd
 from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 # Environment Variables
@@ -15,10 +16,19 @@ SSM_URL = 'http://localhost:2773/systemsmanager/parameters/get?withDecryption=tr
 INTERVALS_UID_PARAM = f'/{PROJECT_NAME}/intervals/uid'
 SNS_TOPIC = os.getenv('SNS_TOPIC')
 NOTIFICATIONS_ENABLED = os.getenv('NOTIFICATIONS_ENABLED')
+DYNAMODB_TABLE = os.getenv('DYNAMODB_TABLE')
+MAX_QUERY_WORKERS = int(os.getenv('MAX_QUERY_WORKERS', '4'))
+ANOMALY_Z_THRESHOLD = float(os.getenv('ANOMALY_Z_THRESHOLD', '1.5'))
+
+# Wellness baseline maintained by the export function
+HEALTH_STATS_SK = 'STATS#HEALTH'
+HEALTH_STATS_LABELS = {'weight': 'Weight', 'restingHR': 'Resting HR', 'hrv': 'HRV', 'steps': 'Steps'}
+MIN_WINDOW_DAYS = 14
+MAX_STATS_AGE_DAYS = 2
 
 SNS_CLIENT = boto3.client('sns')
 dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.getenv('DYNAMODB_TABLE'))
+table = dynamodb.Table(DYNAMODB_TABLE)
 
 def fetch_intervals_uid():
     """Fetch Intervals UID from AWS SSM Parameter Store with a retry mechanism. This is needed as it can take a little bit of time for the layer to be ready."""
@@ -30,36 +40,155 @@ def fetch_intervals_uid():
         time.sleep(0.1)
     raise Exception("Failed to fetch Intervals UID after multiple attempts.")
 
-def get_date_ranges():
-    """Calculate start and end dates for monthly or weekly comparisons."""
+def get_triggering_period(event):
+    """Work out which EventBridge rule (weekly or monthly) invoked the function, if any."""
+    for resource in event.get('resources', []):
+        rule_name = resource.split('/')[-1]
+        if rule_name.endswith('_notify_monthly'):
+            return 'monthly'
+        if rule_name.endswith('_notify_weekly'):
+            return 'weekly'
+    return None
+
+def get_date_ranges(trigger=None):
+    """Calculate start and end dates for every report due on this run.
+    When the first of the month is a Monday, the monthly run sends both reports and the weekly run sends nothing."""
     now = datetime.now()
-    
-    if now.day == 1:  # Monthly case
+    reports = []
+
+    if now.day == 1 and trigger != 'weekly':  # Monthly case
         first_day_last_month = now.replace(day=1) - timedelta(days=1)
-        start_date = first_day_last_month.replace(day=1).strftime('%Y-%m-%dT%H:%M:%S')
-        end_date = first_day_last_month.strftime('%Y-%m-%dT%H:%M:%S')
-        return start_date, end_date, None, None, 'monthly'
+        reports.append({
+            'period': 'monthly',
+            'start_date': first_day_last_month.replace(day=1).strftime('%Y-%m-%dT%H:%M:%S'),
+            'end_date': first_day_last_month.strftime('%Y-%m-%dT%H:%M:%S'),
+            'compare_start': None,
+            'compare_end': None
+        })
 
-    if now.weekday() == 0:  # Weekly case (Monday)
+    if now.weekday() == 0 and not (trigger == 'weekly' and now.day == 1):  # Weekly case (Monday)
         last_week_start = now - timedelta(days=now.weekday() + 7)
         last_week_end = last_week_start + timedelta(days=6)
         prev_week_start = last_week_start - timedelta(days=7)
         prev_week_end = last_week_end - timedelta(days=7)
+        reports.append({
+            'period': 'weekly',
+            'start_date': last_week_start.strftime('%Y-%m-%dT%H:%M:%S'),
+            'end_date': last_week_end.strftime('%Y-%m-%dT%H:%M:%S'),
+            'compare_start': prev_week_start.strftime('%Y-%m-%dT%H:%M:%S'),
+            'compare_end': prev_week_end.strftime('%Y-%m-%dT%H:%M:%S')
+        })
 
-        return (last_week_start.strftime('%Y-%m-%dT%H:%M:%S'), last_week_end.strftime('%Y-%m-%dT%H:%M:%S'),
-                prev_week_start.strftime('%Y-%m-%dT%H:%M:%S'), prev_week_end.strftime('%Y-%m-%dT%H:%M:%S'), 'weekly')
+    return reports
 
-    return None, None, None, None, None  # No relevant period
+def merge_ranges(ranges):
+    """Merge overlapping (start, end) date ranges so each span of the index is only read once."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def plan_queries(reports, intervals_uid):
+    """Work out the merged date ranges to read for each partition key across all reports due today."""
+    ranges = {}
+    for report in reports:
+        for record_type in ('ACTIVITY', 'HEALTH', 'PR'):
+            ranges.setdefault(f'{intervals_uid}#{record_type}', []).append((report['start_date'], report['end_date']))
+        if report['compare_start'] and report['compare_end']:
+            ranges[f'{intervals_uid}#HEALTH'].append((report['compare_start'], report['compare_end']))
+
+    return {partition_key: merge_ranges(key_ranges) for partition_key, key_ranges in ranges.items()}
 
 def query_table(index_name, partition_key, start_date, end_date):
-    """Query DynamoDB table with given parameters."""
-    response = table.query(
-        IndexName=index_name,
-        KeyConditionExpression=(
-            Key('GSI1PK').eq(partition_key) & Key('GSI1SK').between(start_date, end_date)
-        ),
+    """Query DynamoDB table with given parameters, following pagination. Uses the table's client as it is thread safe."""
+    query_args = {
+        'TableName': DYNAMODB_TABLE,
+        'IndexName': index_name,
+        'KeyConditionExpression': Key('GSI1PK').eq(partition_key) & Key('GSI1SK').between(start_date, end_date),
+    }
+    items = []
+    while True:
+        response = table.meta.client.query(**query_args)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def run_queries(plan, intervals_uid):
+    """Run every planned query, along with the wellness statistics read, concurrently on a bounded thread pool."""
+    with ThreadPoolExecutor(max_workers=MAX_QUERY_WORKERS) as executor:
+        health_stats = executor.submit(fetch_health_stats, intervals_uid)
+        futures = {
+            (partition_key, start, end): executor.submit(query_table, 'GSI1', partition_key, start, end)
+            for partition_key, key_ranges in plan.items()
+            for start, end in key_ranges
+        }
+        return {query: future.result() for query, future in futures.items()}, health_stats.result()
+
+def slice_items(results, partition_key, start_date, end_date):
+    """Return the items for a partition key between two dates from the merged query results."""
+    for (key, start, end), items in results.items():
+        if key == partition_key and start <= start_date and end_date <= end:
+            return [item for item in items if start_date <= item['GSI1SK'] <= end_date]
+    return []
+
+def fetch_health_stats(intervals_uid):
+    """Fetch the running wellness statistics item written by the export function."""
+    response = table.meta.client.query(
+        TableName=DYNAMODB_TABLE,
+        KeyConditionExpression=Key('PK').eq(f'USER#{intervals_uid}') & Key('SK').eq(HEALTH_STATS_SK)
     )
-    return response.get('Items', [])
+    items = response.get('Items', [])
+    return items[0] if items else None
+
+def crunch_health_anomalies(stats):
+    """Flag wellness fields whose average over the last 7 days deviates from the athlete's baseline by more than ANOMALY_Z_THRESHOLD.
+    The baseline is the rest of the 28 day window, falling back to the all time Welford statistics while the window is short."""
+    now = datetime.now()
+    if not stats or not stats.get('last_date'):
+        return {}
+    if stats['last_date'] < (now - timedelta(days=MAX_STATS_AGE_DAYS)).strftime('%Y-%m-%d'):
+        print(f"Wellness statistics are stale (last updated for {stats['last_date']}). Skipping alerts.")
+        return {}
+
+    recent_cutoff = (now - timedelta(days=7)).strftime('%Y-%m-%d')
+    anomalies = {}
+    for field, label in HEALTH_STATS_LABELS.items():
+        field_stats = stats.get(field)
+        if not field_stats:
+            continue
+
+        window = {d: float(v) for d, v in field_stats['window'].items()}
+        recent = [v for d, v in window.items() if d >= recent_cutoff]
+        baseline = [v for d, v in window.items() if d < recent_cutoff]
+        if not recent:
+            continue
+
+        if len(baseline) >= MIN_WINDOW_DAYS:
+            baseline_mean = sum(baseline) / len(baseline)
+            baseline_std = (sum((v - baseline_mean) ** 2 for v in baseline) / (len(baseline) - 1)) ** 0.5
+        elif int(field_stats['count']) >= MIN_WINDOW_DAYS:
+            baseline_mean = float(field_stats['mean'])
+            baseline_std = (float(field_stats['m2']) / (int(field_stats['count']) - 1)) ** 0.5
+        else:
+            continue
+
+        if baseline_std == 0:
+            continue
+
+        recent_mean = sum(recent) / len(recent)
+        z_score = (recent_mean - baseline_mean) / baseline_std
+        if abs(z_score) > ANOMALY_Z_THRESHOLD:
+            anomalies[label] = {
+                'avg_7d': round(recent_mean, 1),
+                'baseline': round(baseline_mean, 1),
+                'z_score': round(z_score, 1)
+            }
+
+    return anomalies
 
 def crunch_activity_numbers(items):
     """Process activity stats using Pandas."""
@@ -153,7 +282,7 @@ def process_personal_records(pr_items):
 
     return pr_summary
 
-def notify(activity, health, pr_stats, period):
+def notify(activity, health, pr_stats, anomalies, period):
     """Format and send notification message."""
     if 'avg_weight_diff' in health:
         message = (
@@ -191,6 +320,14 @@ def notify(activity, health, pr_stats, period):
         for activity, records in pr_stats.items():
             message += f"\n{activity.title()}:\n" + "\n".join(records)
 
+    # Append wellness deviations from baseline if any
+    if anomalies:
+        message += "\n\n<b>Wellness Alerts:</b>\n"
+        message += "\n".join(
+            f"{label}: 7 day average of {stats['avg_7d']} vs baseline of {stats['baseline']} (z-score {stats['z_score']:+})"
+            for label, stats in anomalies.items()
+        )
+
     print(message)
     if NOTIFICATIONS_ENABLED:
         SNS_CLIENT.publish(TopicArn=SNS_TOPIC, Subject="Training Stats", Message=message)
@@ -198,32 +335,38 @@ def notify(activity, health, pr_stats, period):
 def main(event, context):
     """Main function to fetch, process, and notify about activity and health data."""
     try:
-        start_date, end_date, compare_start, compare_end, period = get_date_ranges()
-        if not start_date:
-            print("Neither the start of a week nor a month. Exiting.")
+        reports = get_date_ranges(get_triggering_period(event))
+        if not reports:
+            print("No reports due on this run. Exiting.")
             return
-        
+
         intervals_uid = fetch_intervals_uid()
+        results, wellness_stats = run_queries(plan_queries(reports, intervals_uid), intervals_uid)
+        anomalies = crunch_health_anomalies(wellness_stats)
 
-        partition_key = f'{intervals_uid}#ACTIVITY'
-        activity_items = query_table('GSI1', partition_key, start_date, end_date)
-        activity_stats = crunch_activity_numbers(activity_items)
+        for report in reports:
+            start_date, end_date = report['start_date'], report['end_date']
+            compare_start, compare_end = report['compare_start'], report['compare_end']
 
-        partition_key = f'{intervals_uid}#HEALTH'
-        health_items = query_table('GSI1', partition_key, start_date, end_date)
-        if compare_start is None or compare_end is None:
-            print("No data to compare to.")
-            compare_items = None
-        else:
-            compare_items = query_table('GSI1', partition_key, compare_start, compare_end)
-        health_stats = crunch_health_numbers(health_items, compare_items)
+            activity_items = slice_items(results, f'{intervals_uid}#ACTIVITY', start_date, end_date)
+            activity_stats = crunch_activity_numbers(activity_items)
+
+            partition_key = f'{intervals_uid}#HEALTH'
+            health_items = slice_items(results, partition_key, start_date, end_date)
+            if compare_start is None or compare_end is None:
+                print("No data to compare to.")
+                compare_items = None
+            else:
+                compare_items = slice_items(results, partition_key, compare_start, compare_end)
+            health_stats = crunch_health_numbers(health_items, compare_items)
 
-        # Fetch personal records (PRs)
-        partition_key = f'{intervals_uid}#PR'
-        pr_items = query_table('GSI1', partition_key, start_date, end_date)
-        pr_stats = process_personal_records(pr_items)
+            # Personal records (PRs)
+            pr_items = slice_items(results, f'{intervals_uid}#PR', start_date, end_date)
+            pr_stats = process_personal_records(pr_items)
 
-        notify(activity_stats, health_stats, pr_stats, period)
+            # Wellness alerts cover the last 7 days so only go on the final (weekly, if due) report
+            report_anomalies = anomalies if report is reports[-1] else None
+            notify(activity_stats, health_stats, pr_stats, report_anomalies, report['period'])
 
     except Exception as e:
         print(f"Error: {e}")